@@ -4,17 +4,25 @@
 
 import asyncio
 import os
-import io
-import json
 import datetime
 import random
+import queue
+import shutil
+import tempfile
+import threading
+from functools import partial
+from typing import Optional
 import yaml
 
 import hydra
 import logging
+import orjson
 from omegaconf import DictConfig, OmegaConf
 import torch
 import numpy as np
+from celery import group
+from celery.result import ResultSet
+from tqdm import tqdm
 
 import peano
 import worker
@@ -34,22 +42,121 @@ FAIL = "fail"
 DISTRIBUTED = os.environ.get('DISTRIBUTED', False)
 
 
-def submit_task(agent_dump: bytes, theory: worker.BackgroundTheory, statement: str, search_budget=None):
-    if DISTRIBUTED:
-        return worker.try_prove.apply_async((agent_dump, theory, statement, search_budget))
+def dump_agent_shared(agent, checkpoint_path: Optional[str] = None) -> str:
+    '''Saves the agent once to a file that all prover tasks load by path.
+
+    Workers on other nodes must be able to read it, so in distributed mode the file
+    goes to the run directory; otherwise it is kept in memory under /dev/shm.
+    If the agent was just saved to checkpoint_path, that file is copied instead.'''
+    if DISTRIBUTED or not os.path.isdir('/dev/shm'):
+        dump_dir = os.getcwd()
     else:
-        return worker.try_prove.run(agent_dump, theory, statement, search_budget)
+        dump_dir = '/dev/shm'
+
+    fd, path = tempfile.mkstemp(prefix='agent-', suffix='.pt', dir=dump_dir)
+
+    try:
+        if checkpoint_path is not None:
+            os.close(fd)
+            shutil.copyfile(checkpoint_path, path)
+        else:
+            with os.fdopen(fd, 'wb') as f:
+                torch.save(agent, f, _use_new_zipfile_serialization=True)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def evict_agent_shared(agent_handle: str):
+    '''Drops the copy of the agent that tasks in this process loaded from agent_handle.
+    In single-process mode tasks run in the teacher, so otherwise a second copy of
+    the model would stay alive through training.'''
+    if not DISTRIBUTED:
+        worker._AGENT_CACHE.pop(agent_handle, None)
+
+
+def release_agent_shared(agent_handle: str):
+    os.remove(agent_handle)
+    evict_agent_shared(agent_handle)
+
 
+def submit_tasks(agent_handle: str, theory: worker.BackgroundTheory, statements: list[str], search_budget=None,
+                 seed: Optional[int] = None):
+    '''Submits one proof task per statement; in distributed mode they are published as a single group.
+    If seed is given, the task for statements[j] is seeded with seed + j.'''
+    seeds = [None if seed is None else (seed + j) % 2**32 for j in range(len(statements))]
 
-def get_task_result(task):
     if DISTRIBUTED:
-        return task.get()
+        return group(worker.try_prove.s(agent_handle, theory, statement, search_budget, task_seed)
+                     for statement, task_seed in zip(statements, seeds)).apply_async()
     else:
-        return task
+        return [worker.try_prove.run(agent_handle, theory, statement, search_budget, task_seed)
+                for statement, task_seed in zip(statements, seeds)]
+
+
+def get_task_results(tasks):
+    '''Collects the results of all tasks in the order they were submitted.
+    Progress is reported as tasks complete, in whatever order that happens.'''
+    if not DISTRIBUTED:
+        return tasks
+
+    result_set = tasks if isinstance(tasks, ResultSet) else ResultSet(tasks)
+    positions = {task.id: j for j, task in enumerate(result_set.results)}
+    results = [None] * len(positions)
+
+    with tqdm(total=len(positions)) as progress:
+        def collect(task_id, result):
+            results[positions[task_id]] = result
+            progress.update()
+
+        if result_set.supports_native_join:
+            result_set.join_native(callback=collect)
+        else:
+            result_set.join(callback=collect)
+
+    return results
+
+
 
+def _drain_writes(writes: queue.Queue, errors: list):
+    'Runs queued file writes in the background, off the training loop; failures go to errors.'
+    while True:
+        write = writes.get()
+        try:
+            write()
+        except Exception as e:
+            log.exception('Error in background write.')
+            errors.append(e)
+        finally:
+            writes.task_done()
 
 
-async def teacher_loop(cfg: DictConfig, mle_log: MLELogger):
+def _wait_for_writes(writes: queue.Queue, errors: list):
+    'Blocks until all queued writes are done, re-raising the first one that failed.'
+    writes.join()
+    if errors:
+        raise errors[0]
+
+
+def _write_jsonl(f, obj):
+    f.write(orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE).decode())
+
+
+def _fsync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def classify_difficulty(logprobs, thresholds: np.ndarray, bucket_names: np.ndarray) -> list[str]:
+    '''Returns, for each logprob, the name of the first difficulty bucket whose
+    threshold is at least that logprob (the last bucket if there is none).'''
+    logprobs = np.fromiter(logprobs, dtype=float)
+    bucket_idx = np.searchsorted(thresholds, logprobs, side='left')
+    return bucket_names[np.minimum(bucket_idx, len(bucket_names) - 1)].tolist()
+
+
+async def teacher_loop(cfg: DictConfig, mle_log: MLELogger, rng: random.Random):
     log.info('Running in %s', 'distributed mode.' if DISTRIBUTED else 'single-process mode.')
     agent = make_agent(cfg, mle_log)
 
@@ -57,6 +164,7 @@ async def teacher_loop(cfg: DictConfig, mle_log: MLELogger):
     # FIXME(f.srambical): check whether the goal set is correctly formatted (check the first few finetuning examples)
     final_goals_formatted, final_solutions = load_final_goals(os.path.join(os.path.dirname(__file__), '../goals', cfg.goals + '.json'))
     final_goals = ["Conj:(hard) " + g for g in final_goals_formatted]
+    final_goals_set = set(final_goals_formatted)
 
     with open(os.path.join(os.path.dirname(__file__), 'theories', cfg.theory.name + '.p')) as f:
         theory = f.read()
@@ -64,12 +172,15 @@ async def teacher_loop(cfg: DictConfig, mle_log: MLELogger):
     difficulty_buckets = sorted([list(cfg.difficulty_buckets[i].items())[0]
                                  for i in range(len(cfg.difficulty_buckets))],
                                 key=lambda kv: kv[1])
+    bucket_names = np.array([k for k, _ in difficulty_buckets])
 
     premises = cfg.theory.premises
 
     d = peano.PyDerivation()
     d.incorporate(theory)
     proven_conjectures = []
+    # Mirrors proven_conjectures for constant-time membership tests.
+    proven_conjectures_set = set()
     seen_hindsight_goals = set()
     proofs = []
     student_results_final = []
@@ -96,50 +207,63 @@ async def teacher_loop(cfg: DictConfig, mle_log: MLELogger):
                 model_info = yaml.safe_load(f)
             start_iteration = model_info['iteration'] + 1
 
-    if cfg.get('freeze_conjecturer', False):
+    freeze_conjecturer = cfg.get('freeze_conjecturer', False)
+    val_every = cfg.get('val_every', 1)
+    # Result of the most recent validation, reported again on iterations that skip it.
+    val_loss, num_mcts_steps = None, None
+    if freeze_conjecturer:
         log.info('Ablation: Freezing conjecturer.')
 
 
-    with open('log.jsonl', 'w') as log_file:
+    # Logs and per-iteration JSON dumps are written by a background thread.
+    writes, write_errors = queue.Queue(), []
+    threading.Thread(target=_drain_writes, args=(writes, write_errors), daemon=True).start()
+
+    agent_handle = None
+
+    with open('log.jsonl', 'w', buffering=1) as log_file:
         for i in range(start_iteration, cfg.agent.policy.total_iterations):
             context = Context(d, None, [])
 
-            # Dump current agent.
-            buff = io.BytesIO()
-            torch.save(agent, buff)
-            agent_dump = buff.getvalue()
+            # Dump current agent once; tasks only carry the path to the dump.
+            # The agent only changes when trained, so an untrained dump is reused.
+            if agent_handle is None:
+                agent_handle = dump_agent_shared(agent)
 
 
             # 1- Run conjecturing model to obtain N conjectures.
             log.info('Iteration #%d: making conjectures...', i)
 
             conjectures = []
+            conjectures_set = set()
 
             while len(conjectures) < cfg.n_conjectures:
-                proposal = sample_conjecture(AgentLM(agent, 'Conj:(hard) '), context)
+                proposal = sample_conjecture(AgentLM(agent, 'Conj:(hard) '), context, rng=rng)
 
-                if proposal and proposal not in conjectures + proven_conjectures:
+                if proposal and proposal not in conjectures_set and proposal not in proven_conjectures_set:
                     contracted_proposal = d.contract(proposal)
-                    if contracted_proposal and contracted_proposal not in conjectures + proven_conjectures:
+                    if (contracted_proposal and contracted_proposal not in conjectures_set and
+                            contracted_proposal not in proven_conjectures_set):
                         conjectures.append(contracted_proposal)
+                        conjectures_set.add(contracted_proposal)
 
 
             # Contract conjectures to make them Peano-parseable.
-            conjectured_final_goals = set(conjectures) & set(final_goals_formatted)
+            conjectured_final_goals = conjectures_set & final_goals_set
 
             log.info('Done making %d conjectures', len(conjectures))
             log.info('Conjectures: %s', conjectures)
             log.info('Conjectured %d final goals', len(conjectured_final_goals))
 
-            log_file.write(json.dumps({'iteration': i,
-                                  'msg': f'It #{i}: posing {len(conjectures)} conjectures.',
-                                  'conjectures': conjectures}))
-            log_file.write('\n')
-            log_file.flush()
+            writes.put(partial(_write_jsonl, log_file,
+                               {'iteration': i,
+                                'msg': f'It #{i}: posing {len(conjectures)} conjectures.',
+                                'conjectures': conjectures}))
 
             # 2- Try to prove each of the conjectures
             examples = []
-            student_results= prove_conjectures(agent_dump, conjectures, theory, premises)
+            student_results= prove_conjectures(agent_handle, conjectures, theory, premises,
+                                               seed=rng.getrandbits(32))
 
             # 3- Train model on proofs and outcome of conjectures (easy, hard, timeout)
             # 3a- Look at all the success logprobs and compute the easy/hard threhsold.
@@ -156,61 +280,75 @@ async def teacher_loop(cfg: DictConfig, mle_log: MLELogger):
             # Add output of proving final goals to the list of proven conjectures
             student_results.extend(student_results_final)
 
-            thresholds = [np.percentile(success_logprobs, p)
-                          for _, p in difficulty_buckets]
+            success_logprobs_arr = np.asarray(success_logprobs)
+            thresholds = np.percentile(success_logprobs_arr, [p for _, p in difficulty_buckets])
 
 
             log.debug('Thresholds: %s, min = %f, max = %f',
                         list(zip([k for k, _ in difficulty_buckets], thresholds)),
-                        np.min(success_logprobs),
-                        np.max(success_logprobs))
+                        np.min(success_logprobs_arr),
+                        np.max(success_logprobs_arr))
 
-            hard_sol_log_probs = [logprob for logprob in success_logprobs if logprob >= thresholds[0]]
-            mean_hard_sol_log_prob = np.mean(hard_sol_log_probs) if hard_sol_log_probs else 0
+            hard_sol_log_probs = success_logprobs_arr[success_logprobs_arr >= thresholds[0]]
+            mean_hard_sol_log_prob = np.mean(hard_sol_log_probs) if hard_sol_log_probs.size else 0
             # 3b- Classify problems into easy/hard.
+            # Outcome is the name of the first difficulty bucket that is larger than the logprob.
+            # All logprobs are classified at once, then consumed in the same order below.
+            success_outcomes = iter(classify_difficulty(
+                (r.logprob for r in student_results if r.success), thresholds, bucket_names))
+            if cfg.train_policy_on_hindsight_examples:
+                hindsight_outcomes = iter(classify_difficulty(
+                    (h.logprob for r in student_results for h in r.hindsight_examples),
+                    thresholds, bucket_names))
+
             proven_conjectures_iteration = []
             for student_result in student_results:
-                # Outcome is the name of the first difficulty bucket that is larger than the logprob.
                 if student_result.success:
-                    outcome = next(k
-                                   for i, (k, _) in enumerate(difficulty_buckets)
-                                   if (student_result.logprob <= thresholds[i] or
-                                       i + 1 == len(difficulty_buckets)))
+                    outcome = next(success_outcomes)
                 else:
                     outcome = FAIL
 
-                if not cfg.get('freeze_conjecturer', False):
-                    examples.append(f'Conj:({outcome}) ' + d.elaborate(student_result.problem))
+                if not freeze_conjecturer:
+                    # Elaborated once; hindsight examples below reuse it.
+                    elaborated_problem = d.elaborate(student_result.problem)
+                    examples.append(f'Conj:({outcome}) ' + elaborated_problem)
 
                 if student_result.success:
                     proven_conjectures_iteration.append(student_result.problem)
                     proven_conjectures.append(student_result.problem)
+                    proven_conjectures_set.add(student_result.problem)
                     proofs.append(student_result.proof)
 
                 examples.extend(student_result.extracted_examples)
 
                 if cfg.train_policy_on_hindsight_examples:
                     for h in student_result.hindsight_examples:
-                        if h.goal not in seen_hindsight_goals:
-                            outcome = next(k
-                                           for i, (k, _) in enumerate(difficulty_buckets)
-                                           if h.logprob <= thresholds[i] or i + 1 == len(difficulty_buckets))
+                        outcome = next(hindsight_outcomes)
 
-                            if not cfg.get('freeze_conjecturer', False):
-                                examples.append(f'Conj:({outcome}) ' + d.elaborate(student_result.problem))
+                        if h.goal not in seen_hindsight_goals:
+                            if not freeze_conjecturer:
+                                examples.append(f'Conj:({outcome}) ' + elaborated_problem)
                             examples.extend(h.examples)
                             seen_hindsight_goals.add(h.goal)
 
-            log_file.write(json.dumps({'iteration': i,
-                                  'msg': f'Training on {len(examples)} examples.'}))
-            log_file.write('\n')
+            writes.put(partial(_write_jsonl, log_file,
+                               {'iteration': i,
+                                'msg': f'Training on {len(examples)} examples.'}))
 
             # 3c- Train model on conjecturing and proof search examples.
             log.info(f"{len(examples)} accumulated training examples.")
+            evict_agent_shared(agent_handle)
             agent.train(examples=examples, final_goals=final_goals, ratio_proven=ratio_proven, mle_log=mle_log)
-            val_loss, num_mcts_steps = get_val_loss(agent_dump, final_goals_formatted, theory, premises, i)
-            log.info('Validation loss: %f', val_loss)
-            log.info('Number of MCTS steps to solve final goals: %s', num_mcts_steps)
+            # Proving the final goals with the full search budget is expensive, so it only
+            # runs every val_every iterations and on the last one.
+            if (num_mcts_steps is None or i % val_every == 0 or
+                    i + 1 == cfg.agent.policy.total_iterations):
+                val_loss, num_mcts_steps = get_val_loss(agent_handle, final_goals_formatted, theory, premises, i,
+                                                        seed=rng.getrandbits(32))
+                log.info('Validation loss: %f', val_loss)
+                log.info('Number of MCTS steps to solve final goals: %s', num_mcts_steps)
+            release_agent_shared(agent_handle)
+            agent_handle = None
 
             final_goals_proven = [s for s in num_mcts_steps if s <= cfg.agent.max_mcts_nodes]
             log.info('Final goals proven: %d out of %d', len(final_goals_proven), len(final_goals))
@@ -225,25 +363,42 @@ async def teacher_loop(cfg: DictConfig, mle_log: MLELogger):
 
             mle_log.save()
 
-            save_json(examples, f'examples_{i}.json')
-            save_json(proven_conjectures_iteration, f'proven_conj_{i}.json')
+            writes.put(partial(save_json, examples, f'examples_{i}.json'))
+            writes.put(partial(save_json, proven_conjectures_iteration, f'proven_conj_{i}.json'))
+            # Make this iteration's log lines durable; only done once per iteration.
+            writes.put(partial(_fsync, log_file))
             if cfg.checkpoint_per_iteration:
-                torch.save(agent, f"{i}.pt")
+                checkpoint_path = f"{i}.pt"
+                torch.save(agent, checkpoint_path)
             else:
-                torch.save(agent, f"model.pt")
+                checkpoint_path = "model.pt"
+                torch.save(agent, checkpoint_path)
                 model_info['iteration'] = i
                 with open('model_info.yaml', 'w') as f:
                     yaml.dump(model_info, f)
 
+            # The next iteration proves with exactly this agent, so share the
+            # checkpoint bytes instead of serializing the agent a second time.
+            agent_handle = dump_agent_shared(agent, checkpoint_path)
+
+            # Let this iteration's writes finish (they overlap with the checkpoint save).
+            _wait_for_writes(writes, write_errors)
+
             # terminate the learning loop if all final goals are proven
             if len(final_goals_proven) == len(final_goals):
                 log.info('All final goals proven')
                 if cfg.early_exit:
                     break
 
-def get_val_loss(agent_dump, final_goals_formatted, theory, premises, i):
+        _wait_for_writes(writes, write_errors)
+
+    if agent_handle is not None:
+        release_agent_shared(agent_handle)
+
+def get_val_loss(agent_handle, final_goals_formatted, theory, premises, i, seed=None):
     # get logprobs of proving the final goals (with far more mcts steps)
-    student_results_final = prove_conjectures(agent_dump, final_goals_formatted, theory, premises, is_eval=True)
+    student_results_final = prove_conjectures(agent_handle, final_goals_formatted, theory, premises, is_eval=True,
+                                              seed=seed)
     success_logprobs_final = get_log_probs(student_results_final, i)
 
     if len(success_logprobs_final) > 0:
@@ -255,23 +410,15 @@ def get_val_loss(agent_dump, final_goals_formatted, theory, premises, i):
     return -mean_success_logprobs_final, num_mcts_steps
 
 
-def prove_conjectures(agent_dump, conjectures, theory, premises, is_eval=False):
-    tasks = []
+def prove_conjectures(agent_handle, conjectures, theory, premises, is_eval=False, seed=None):
     log.info('Submitting tasks...')
-    for conjecture in conjectures:
-        tasks.append(submit_task(
-            agent_dump,
-            worker.BackgroundTheory(theory, premises),
-            conjecture, 
-            is_eval))
+    tasks = submit_tasks(agent_handle, worker.BackgroundTheory(theory, premises), conjectures, is_eval, seed)
 
     student_results = []
 
     log.info('Collecting %d results from workers.', len(tasks))
 
-    for task in tasks:
-        student_result = get_task_result(task)
-
+    for student_result in get_task_results(tasks):
         if student_result.error:
             log.error('Error in prover process!')
             log.error(student_result.error)
@@ -301,11 +448,15 @@ def main(cfg: DictConfig):
     torch.manual_seed(seed)
     random.seed(seed)
     np.random.seed(seed)
+    # Conjecture sampling and prover task seeds draw from their own generator,
+    # independent of the global state used by training (seeded prover tasks
+    # restore that state when they run in this process).
+    rng = random.Random(seed)
 
     mle_log = setup_mle_logger(cfg)
 
     if cfg.task == 'teacher':
-        asyncio.run(teacher_loop(cfg, mle_log))
+        asyncio.run(teacher_loop(cfg, mle_log, rng))
 
 if __name__ == '__main__':
     main()
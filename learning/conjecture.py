@@ -373,7 +373,7 @@ def pretty_print_conjecture(conjecture: str) -> str:
 
 MAX_OPEN_PARENS = 8
 
-def sample_conjecture(lm, context, max_it=100):
+def sample_conjecture(lm, context, max_it=100, rng=random):
     generation = ''
 
     for _ in range(max_it):
@@ -410,7 +410,7 @@ def sample_conjecture(lm, context, max_it=100):
 
             # Sample the next character using the LM.
             choices = list(set(c[0] for c in completions))
-            choice = random.choices(choices, list(map(math.exp,
+            choice = rng.choices(choices, list(map(math.exp,
                                                       lm.score(choices, mean=False, prefix=generation))))[0]
             generation += choice
             # Filter completions to those starting with the chosen character and drop the character.
@@ -1,10 +1,9 @@
 import argparse
-import io
 import os
-import torch
-import json
-import peano
-import bootstrap
+from concurrent.futures import ThreadPoolExecutor
+
+# torch, bootstrap and util pull in torch, peano and celery; they are imported
+# where needed so that --help and argument errors return immediately.
 
 
 
@@ -14,15 +13,51 @@ import bootstrap
 #           Alternative: python learning/evaluate_model.py --model_path outputs/2024-11-12/23-22-47/1.pt --final_goal_path "goals/nat-add-hard.json" --max_mcts_nodes=10000     # 
 #################################################################################################################################################################################
 
-def load_final_goals(path):
-    goals_dict = json.load(open(path))
-    final_goals = []
-    solutions = []
-    for goal in goals_dict["goals"]:
-        final_goals.append(goal["theorem"])
-        solutions.append(goal["solution"])
+def load_checkpoint(path):
+    # Checkpoints are full agent objects, so weights_only loading does not apply;
+    # mmap still maps tensor storages from the file instead of copying them.
+    import torch
+    return torch.load(path, mmap=True)
+
+
+def load_checkpoints(model_path):
+    'Loads a single .pt file, a run directory with model.pt, or a run directory with per-iteration checkpoints.'
+    if os.path.exists(model_path) and model_path.endswith(".pt"):
+        return {f"checkpoint_{os.path.basename(model_path).split('.')[0]}": load_checkpoint(model_path)}
+    elif os.path.exists(os.path.join(model_path, "model.pt")):
+        return {f"checkpoint_{os.path.basename(model_path).split('.')[0]}": load_checkpoint(os.path.join(model_path, "model.pt"))}
+    elif os.path.exists(os.path.join(model_path, "0.pt")):
+        # Load the checkpoints concurrently so that disk reads overlap with unpickling.
+        checkpoint_paths = {i: os.path.join(model_path, f"{i}.pt") for i in range(15)}
+        checkpoint_paths = {i: path for i, path in checkpoint_paths.items() if os.path.exists(path)}
+        with ThreadPoolExecutor(max_workers=min(len(checkpoint_paths), os.cpu_count())) as executor:
+            futures = {i: executor.submit(load_checkpoint, path) for i, path in checkpoint_paths.items()}
+            return {f"checkpoint_{i}": future.result() for i, future in futures.items()}
+    else:
+        raise FileNotFoundError(f"model_path is neither file nor directory: {model_path}")
+
+
+def evaluate(models, final_goals_formatted, theory, premises, max_mcts_nodes, final_goal_name=""):
+    'Evaluates each model on the final goals; returns the validation loss and mean MCTS steps per checkpoint.'
+    import bootstrap
+
+    json_results = {}
+    for i in models.keys():
+        # Set the search budget
+        models[i]._val_search_budget = int(max_mcts_nodes)
+        # dump the model 
+        agent_handle = bootstrap.dump_agent_shared(models[i])
+        # Evaluate the model
+        print(f"Goal: {final_goal_name} - Evaluating model {i}")
+        try:
+            val_loss, num_mcts_steps = bootstrap.get_val_loss(agent_handle, final_goals_formatted, theory, premises, 0)
+        finally:
+            bootstrap.release_agent_shared(agent_handle)
+        print(f"Validation loss: {val_loss},\t Number of MCTS steps: {sum(num_mcts_steps)/len(num_mcts_steps)}")
+        json_results[f"checkpoint_{i}"] = {"val_loss": val_loss, "num_mcts_steps": sum(num_mcts_steps)/len(num_mcts_steps)}
+
+    return json_results
 
-    return final_goals, solutions
 
 def main():
     parser = argparse.ArgumentParser()
@@ -31,6 +66,8 @@ def main():
     parser.add_argument("--max_mcts_nodes", help="Search budget of MCTS", default=10000)
     args = parser.parse_args()
 
+    from util import load_final_goals, save_json
+
     print("evaluating model" , args.model_path, "on", args.final_goal_path)
 
     theory_dict = {'name': 'nat-add', 'premises': ['eq_refl', 'eq_symm', 'rewrite', '+_z', '+_s', 'nat_ind']}
@@ -38,23 +75,8 @@ def main():
         theory = f.read()
 
     premises = theory_dict["premises"]
-    d = peano.PyDerivation()
-    d.incorporate(theory)
-    
-    # Verify that the model file exists
-    if os.path.exists(args.model_path) and args.model_path.endswith(".pt"):
-        models = {f"checkpoint_{os.path.basename(args.model_path).split('.')[0]}": torch.load(args.model_path)}
-    elif os.path.exists(os.path.join(args.model_path, "model.pt")):
-        models = {f"checkpoint_{os.path.basename(args.model_path).split('.')[0]}": torch.load(os.path.join(args.model_path, "model.pt"))}
-    elif os.path.exists(os.path.join(args.model_path, "0.pt")):
-        models = {}
-        for i in range(15):
-            if os.path.exists(os.path.join(args.model_path, f"{i}.pt")):
-                models[f"checkpoint_{i}"] = torch.load(os.path.join(args.model_path, f"{i}.pt"))
-            else:
-                continue
-    else:
-        raise FileNotFoundError(f"model_path is neither file nor directory: {args.model_path}")
+
+    models = load_checkpoints(args.model_path)
     # load final_goal from final_goal_path 
     final_goal_path = args.final_goal_path
 
@@ -66,30 +88,15 @@ def main():
     else:
         raise FileNotFoundError(f"final_goal_path does not exist: {final_goal_path}")
 
-
-    json_results = {}
     final_goal_name = os.path.basename(final_goal_path).split(".")[0]
-    for i in models.keys():
-        # Set the search budget
-        models[i]._val_search_budget = int(args.max_mcts_nodes)
-        # dump the model 
-        buff = io.BytesIO()
-        torch.save(models[i], buff)
-        agent_dump = buff.getvalue()
-        # Evaluate the model
-        print(f"Goal: {final_goal_name} - Evaluating model {i}")
-        val_loss, num_mcts_steps = bootstrap.get_val_loss(agent_dump, final_goals_formatted, theory, premises, 0)
-        print(f"Validation loss: {val_loss},\t Number of MCTS steps: {sum(num_mcts_steps)/len(num_mcts_steps)}")
-        json_results[f"checkpoint_{i}"] = {"val_loss": val_loss, "num_mcts_steps": sum(num_mcts_steps)/len(num_mcts_steps)}
+    json_results = evaluate(models, final_goals_formatted, theory, premises, args.max_mcts_nodes, final_goal_name)
 
     print(f"Saving results to {os.path.join(args.model_path, f'{final_goal_name}_per_checkpoint_val_loss.json')}")
     print(json_results)
     if args.model_path.endswith(".pt"):
-        with open(os.path.join(os.path.dirname(args.model_path), f"{final_goal_name}_per_checkpoint_val_loss.json"), "w") as f:
-            json.dump(json_results, f)
+        save_json(json_results, os.path.join(os.path.dirname(args.model_path), f"{final_goal_name}_per_checkpoint_val_loss.json"))
     else: 
-        with open(os.path.join(args.model_path, f"{final_goal_name}_per_checkpoint_val_loss.json"), "w") as f:
-            json.dump(json_results, f)
+        save_json(json_results, os.path.join(args.model_path, f"{final_goal_name}_per_checkpoint_val_loss.json"))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
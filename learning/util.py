@@ -10,6 +10,7 @@ from contextlib import contextmanager
 from functools import wraps
 
 import altair
+import orjson
 import torch
 import numpy as np
 from typing import Dict
@@ -47,14 +48,14 @@ def format_parameter_count(model):
     return f'{n / 10**6:.1f}B'
 
 def load_final_goals(path):
-    goals_dict = json.load(open(path))
-    final_goals = []
-    solutions = []
+    with open(path, 'rb') as f:
+        goals_dict = orjson.loads(f.read())
+    # Map each theorem to its first solution, dropping repeated theorems but keeping file order.
+    solutions_by_goal = {}
     for goal in goals_dict["goals"]:
-        final_goals.append(goal["theorem"])
-        solutions.append(goal["solution"])
+        solutions_by_goal.setdefault(goal["theorem"], goal["solution"])
 
-    return final_goals, solutions
+    return list(solutions_by_goal.keys()), list(solutions_by_goal.values())
 
 def encode_batch(b: list[str], device: torch.device, bos=True, eos=True) -> torch.LongTensor:
     if not b:
@@ -341,8 +342,8 @@ def time_limit(seconds):
 
 
 def save_json(obj, path):
-    with open(path, 'w') as f:
-        json.dump(obj, f)
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY))
 
 
 def replace(l: tuple, i: int, x: object):
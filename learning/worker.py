@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 
-import io
 from dataclasses import dataclass
 from typing import Optional
 import traceback
 import os
+import random
 
 import torch
 import logging
@@ -45,11 +45,46 @@ app.conf.result_serializer = 'pickle'
 app.conf.accept_content = ['application/json', 'application/x-python-serialize']
 
 
+# Agents loaded by this worker, keyed by the handle they were dumped to.
+# The teacher dumps a new agent every iteration, so only the latest one is kept.
+_AGENT_CACHE = {}
+
+
+def load_agent_shared(agent_handle: str):
+    agent = _AGENT_CACHE.get(agent_handle)
+
+    if agent is None:
+        _AGENT_CACHE.clear()
+        # Dumps use the zip format, so tensor storages are mapped from the file
+        # instead of being read and copied up front.
+        agent = torch.load(agent_handle, mmap=True)
+        _AGENT_CACHE[agent_handle] = agent
+
+    return agent
+
+
 @app.task
-def try_prove(agent_dump: bytes, theory: BackgroundTheory, statement: str, is_eval: bool = False) -> StudentResult:
+def try_prove(agent_handle: str, theory: BackgroundTheory, statement: str, is_eval: bool = False,
+              seed: Optional[int] = None) -> StudentResult:
+    if seed is None:
+        return _try_prove(agent_handle, theory, statement, is_eval)
+
+    # Seeded per task, so the outcome does not depend on which worker runs it.
+    # In single-process mode tasks run inside the teacher, whose global RNGs
+    # also drive training, so their state is restored after the search.
+    random_state = random.getstate()
+    try:
+        with torch.random.fork_rng(devices=range(torch.cuda.device_count())):
+            random.seed(seed)
+            torch.manual_seed(seed)
+            return _try_prove(agent_handle, theory, statement, is_eval)
+    finally:
+        random.setstate(random_state)
+
+
+def _try_prove(agent_handle: str, theory: BackgroundTheory, statement: str, is_eval: bool) -> StudentResult:
     try:
-        with io.BytesIO(agent_dump) as f:
-            agent = torch.load(f)
+        agent = load_agent_shared(agent_handle)
 
         log.debug('Proving %s on %s', statement, agent._policy._lm._lm.device)
 
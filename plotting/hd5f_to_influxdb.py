@@ -128,7 +128,7 @@ def process_experiment(experiment_path, client, write_api, bucket, org, hash_cac
             for metric, value in fields.items():
                 try:
                     value = float(value)
-                    if not (math.isnan(value) or math.isinf(value)):
+                    if math.isfinite(value):
                         point_dict["fields"][metric] = value
                 except (ValueError, TypeError):
                     logging.warning(f"Error processing metric {metric} with value {value}")
@@ -1,24 +1,70 @@
+import argparse
 import h5py
 import yaml
 import logging
 import numpy as np
-from datetime import datetime
 import os
 import json
 import hashlib
+import itertools
 import sqlite3
+import stat
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
+# The libyaml C loader parses configs several times faster; PyYAML builds without it fall back
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 logging.basicConfig(level=logging.INFO)
 
+# Commit (and save the hash cache) after this many experiments, so a crash loses at most that much work
+COMMIT_EVERY = 20
+
+# (group, dataset) columns logged at the last step of each iteration, and at every other step
+COLUMNS = {
+    'iteration': [("time", "num_iterations"), ("stats", "val_loss"), ("stats", "final_goals_proven"),
+                  ("stats", "ratio_proven"), ("stats", "mean_hard_sol_log_probs")],
+    'step': [("time", "num_steps"), ("stats", "loss"), ("stats", "train_loss"), ("stats", "progress_loss"),
+             ("stats", "mu"), ("stats", "ratio_diff_problem_pairs")],
+}
+
+# Below this many existing rows, indexes are dropped during ingest and rebuilt once afterwards;
+# above it, rebuilding them would cost more than maintaining them for the new rows
+REBUILD_INDEXES_MAX_ROWS = 1_000_000
+
+# Raw chunk cache for the log file: 64 MiB with a prime slot count well above the number of chunks,
+# so compressed chunks are decompressed once even if several columns share them
+H5_OPEN_KWARGS = dict(rdcc_nbytes=64 * 1024 * 1024, rdcc_nslots=100003, rdcc_w0=0.75, libver="latest")
+
+# Logs smaller than this are read into memory in one go instead of through per-read syscalls
+IN_MEMORY_MAX_BYTES = 512 * 1024 * 1024
+
+# Bump when the table layout changes; older databases are rebuilt from the logs
+SCHEMA_VERSION = 2
+
+INSERT_SQL = """
+    INSERT INTO metrics (run_id, metric_id, log_index, timestamp, value)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+def file_fingerprint(file_path):
+    """Cheap change-detection key for a file: its size and modification time."""
+    st = os.stat(file_path)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+def configs_fingerprint(config_yaml, hydra_yaml):
+    """Fingerprint of an experiment's config.yaml and hydra.yaml, tolerating a missing hydra.yaml."""
+    return "|".join(file_fingerprint(f) if os.path.exists(f) else "" for f in (config_yaml, hydra_yaml))
+
 def calculate_file_hash(file_path):
     """Calculate SHA-256 hash of a file."""
-    sha256_hash = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        # Read the file in chunks to handle large files efficiently
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+    # file_digest reads and hashes in large blocks without a Python-level loop
+    with open(file_path, "rb", buffering=0) as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
 
 def load_hash_cache(cache_file):
     """Load the hash cache from JSON file."""
@@ -29,46 +75,225 @@ def load_hash_cache(cache_file):
         return {}
 
 def save_hash_cache(cache_file, cache):
-    """Save the hash cache to JSON file."""
-    with open(cache_file, 'w') as f:
-        json.dump(cache, f, indent=2)
+    """Save the hash cache to JSON file.
+
+    Writes to a temporary file in the same directory and renames it over the cache,
+    so a crash mid-write leaves the previous cache intact instead of a truncated one.
+    """
+    # mkstemp creates the file as 0600; give it the cache's current mode, or the usual
+    # umask-based one for a new cache, so the rename does not change its permissions
+    try:
+        mode = stat.S_IMODE(os.stat(cache_file).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+
+    fd, tmp_path = tempfile.mkstemp(prefix=".hdf5_sqlite_cache-", suffix=".json", dir=os.path.dirname(cache_file))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, cache_file)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def configure_connection(conn, fast=False):
+    """Tune SQLite for bulk ingest of a database that can be rebuilt from the HDF5 logs."""
+    conn.execute("PRAGMA journal_mode=WAL")
+    # NORMAL only syncs at WAL checkpoints; OFF never syncs and can corrupt the DB on power loss
+    conn.execute(f"PRAGMA synchronous={'OFF' if fast else 'NORMAL'}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")  # 64 MiB
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 MiB
 
 def create_tables(conn):
-    """Create necessary database tables if they don't exist."""
+    """Create necessary database tables if they don't exist.
+
+    A metrics table with an older schema (PRAGMA user_version below SCHEMA_VERSION) is renamed
+    to metrics_v<version> and its rows are migrated into the current tables, so data for
+    experiments whose logs are gone is kept.
+    """
     cursor = conn.cursor()
+    cursor.execute("BEGIN")
+    try:
+        (user_version,) = cursor.execute("PRAGMA user_version").fetchone()
+        has_metrics = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'metrics'").fetchone() is not None
+        old_table = None
+        if user_version < SCHEMA_VERSION and has_metrics:
+            old_table = f"metrics_v{user_version}"
+            logging.info(f"Database schema version {user_version} is outdated, migrating {old_table} "
+                         f"to version {SCHEMA_VERSION}")
+            # The view and index names are reused by the new schema
+            cursor.execute("DROP VIEW IF EXISTS metric_rows")
+            for index in ("idx_metrics_timestamp", "idx_metrics_run_name", "idx_metrics_run_metric"):
+                cursor.execute(f"DROP INDEX IF EXISTS {index}")
+            cursor.execute(f"ALTER TABLE metrics RENAME TO {old_table}")
+
+        create_schema(cursor)
+        if old_table is not None:
+            migrate_metrics(cursor, old_table, user_version)
+        create_indexes(conn)
+
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        cursor.execute("COMMIT")
+    except BaseException:
+        cursor.execute("ROLLBACK")
+        raise
+
+def create_schema(cursor):
+    """Create the current tables and view if they don't exist."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        ) STRICT
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metric_names (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            type TEXT NOT NULL
+        ) STRICT
+    ''')
+
+    # One row per logged value; log_index is its row in the HDF5 log, since timestamps only have
+    # minute resolution and repeat within a series. The primary key doubles as the per-run,
+    # per-metric index, and WITHOUT ROWID stores rows clustered in that order.
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS metrics (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            run_name TEXT,
-            timestamp DATETIME,
-            metric_name TEXT,
-            value REAL,
-            metric_type TEXT
-        )
+            run_id INTEGER NOT NULL REFERENCES runs(id),
+            metric_id INTEGER NOT NULL REFERENCES metric_names(id),
+            log_index INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (run_id, metric_id, log_index)
+        ) STRICT, WITHOUT ROWID
     ''')
-    
+
+    # The previous one-row-per-value layout with text datetimes, for ad-hoc queries and plotting
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS metric_rows AS
+        SELECT runs.name AS run_name, datetime(metrics.timestamp, 'unixepoch') AS timestamp,
+               metric_names.name AS metric_name,
+               metrics.value, metric_names.type AS metric_type
+        FROM metrics
+        JOIN runs ON runs.id = metrics.run_id
+        JOIN metric_names ON metric_names.id = metrics.metric_id
+    ''')
+
+def migrate_metrics(cursor, old_table, version):
+    """Copy the rows of a metrics table with schema version 0 or 1 into the current tables.
+
+    The old table is dropped if every row was migrated and kept otherwise.
+    """
+    # Both old schemas stored timestamps as "%Y-%m-%d %H:%M:%S" text; read as UTC like parse_timestamps
+    if version == 0:
+        # One row per value with names inline. The log row of a value was not stored, so log_index
+        # is its position in the series; re-ingesting the run's log replaces these rows.
+        cursor.execute(f"INSERT OR IGNORE INTO runs (name) SELECT DISTINCT run_name FROM {old_table} "
+                       f"WHERE run_name IS NOT NULL")
+        cursor.execute(f"INSERT OR IGNORE INTO metric_names (name, type) "
+                       f"SELECT metric_name, coalesce(max(metric_type), '') FROM {old_table} "
+                       f"WHERE metric_name IS NOT NULL GROUP BY metric_name")
+        cursor.execute(f'''
+            INSERT INTO metrics (run_id, metric_id, log_index, timestamp, value)
+            SELECT runs.id, metric_names.id,
+                   row_number() OVER (PARTITION BY runs.id, metric_names.id ORDER BY old.timestamp, old.id) - 1,
+                   CAST(strftime('%s', old.timestamp) AS INTEGER), old.value
+            FROM {old_table} AS old
+            JOIN runs ON runs.name = old.run_name
+            JOIN metric_names ON metric_names.name = old.metric_name
+            WHERE strftime('%s', old.timestamp) IS NOT NULL AND typeof(old.value) IN ('real', 'integer')
+        ''')
+    else:
+        # Same layout with text timestamps; runs and metric_names are unchanged
+        cursor.execute(f'''
+            INSERT INTO metrics (run_id, metric_id, log_index, timestamp, value)
+            SELECT run_id, metric_id, log_index, CAST(strftime('%s', timestamp) AS INTEGER), value
+            FROM {old_table}
+            WHERE strftime('%s', timestamp) IS NOT NULL
+        ''')
+    migrated = cursor.rowcount
+
+    (total,) = cursor.execute(f"SELECT count(*) FROM {old_table}").fetchone()
+    if migrated == total:
+        cursor.execute(f"DROP TABLE {old_table}")
+        logging.info(f"Migrated {migrated} rows from {old_table} into metrics")
+    else:
+        logging.warning(f"Migrated {migrated} of {total} rows from {old_table} into metrics; "
+                        f"the rest could not be converted and remain in {old_table}")
+
+def create_indexes(conn):
+    """Create the query indexes on metrics if they don't exist."""
+    cursor = conn.cursor()
     # Create an index for faster queries
     cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_metrics_timestamp 
         ON metrics(timestamp)
     ''')
-    
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_metrics_run_name 
-        ON metrics(run_name)
-    ''')
-    
-    conn.commit()
 
-def process_experiment(experiment_path, conn, hash_cache, cache_file):
-    """Process a single experiment directory and write its data to SQLite."""
+def drop_indexes(conn):
+    """Drop the indexes created by create_indexes."""
+    conn.execute("DROP INDEX IF EXISTS idx_metrics_timestamp")
+
+def get_run_id(cursor, run_name):
+    """Return the id of a run, adding it to runs if needed."""
+    cursor.execute("INSERT OR IGNORE INTO runs (name) VALUES (?)", (run_name,))
+    return cursor.execute("SELECT id FROM runs WHERE name = ?", (run_name,)).fetchone()[0]
+
+def get_metric_id(cursor, metric, metric_type):
+    """Return the id of a metric, adding it to metric_names if needed."""
+    cursor.execute("INSERT OR IGNORE INTO metric_names (name, type) VALUES (?, ?)", (metric, metric_type))
+    return cursor.execute("SELECT id FROM metric_names WHERE name = ?", (metric,)).fetchone()[0]
+
+def open_log_file(log_file):
+    """Open an HDF5 log read-only, loading it wholly into memory if it is small enough."""
+    if os.path.getsize(log_file) < IN_MEMORY_MAX_BYTES:
+        # The core driver reads the file into RAM at open; backing_store=False never writes it back
+        return h5py.File(log_file, "r", driver="core", backing_store=False, **H5_OPEN_KWARGS)
+    return h5py.File(log_file, "r", **H5_OPEN_KWARGS)
+
+def parse_timestamps(timestamps):
+    """Parse logged "%y-%m-%d/%H:%M" timestamps in one vectorized pass.
+
+    Rewriting them as ISO 8601 ("20%y-%m-%dT%H:%M") lets numpy parse the whole
+    array at once instead of calling strptime per row. Returns Unix epoch seconds,
+    reading the (timezone-naive) logged times as UTC.
+    """
+    iso = np.char.add("20", np.char.replace(np.char.decode(timestamps, "utf-8"), "/", "T"))
+    return iso.astype("datetime64[s]").astype(np.int64)
+
+def log_file_unchanged(cache_entry, log_file, fingerprint, verify_hash):
+    """Check a hash cache entry against the current log file.
+
+    Entries hold the log file's path, fingerprint and SHA-256 hash (stored whenever the log is
+    ingested). Here the hash is only computed if the fingerprint differs and --verify-hash is set.
+    Returns whether the file is unchanged and the entry to store for it.
+    """
+    if cache_entry is not None and cache_entry.get("fingerprint") == fingerprint:
+        return True, {**cache_entry, "log_file": log_file}
+
+    entry = {"log_file": log_file, "fingerprint": fingerprint}
+    if verify_hash:
+        entry["sha256"] = calculate_file_hash(log_file)
+
+    unchanged = cache_entry is not None and "sha256" in entry and cache_entry.get("sha256") == entry["sha256"]
+    return unchanged, entry
+
+def locate_experiment_files(experiment_path):
+    """Return the (log_file, hydra_yaml, config_yaml) paths of an experiment, or None if they are missing."""
     # Get the actual experiment directory (the timestamped folder)
-    experiment_dirs = [d for d in os.listdir(experiment_path) if os.path.isdir(os.path.join(experiment_path, d))]
+    # scandir reports entry types from the directory listing, without a stat per entry
+    experiment_dirs = [entry.path for entry in os.scandir(experiment_path) if entry.is_dir()]
     if not experiment_dirs:
         logging.warning(f"No experiment directories found in {experiment_path}")
-        return
+        return None
     
-    working_dir = os.path.join(experiment_path, experiment_dirs[0])
+    working_dir = experiment_dirs[0]
     log_file = os.path.join(working_dir, "experiment_dir/logs/log_no_seed_provided.hdf5")
     hydra_yaml = os.path.join(working_dir, ".hydra/hydra.yaml")
     config_yaml = os.path.join(working_dir, ".hydra/config.yaml")
@@ -76,140 +301,213 @@ def process_experiment(experiment_path, conn, hash_cache, cache_file):
     # Skip if required files don't exist
     if not all(os.path.exists(f) for f in [log_file, config_yaml]):
         logging.warning(f"Missing required files in {working_dir}")
-        return
+        return None
+
+    return log_file, hydra_yaml, config_yaml
+
+# Hash cache as loaded by main, installed once in each worker process by init_worker
+_worker_hash_cache = {}
+
+def init_worker(hash_cache):
+    """Give a worker process its read-only copy of the hash cache, instead of pickling it per task."""
+    global _worker_hash_cache
+    _worker_hash_cache = hash_cache
+
+def process_experiment(experiment_files, current_fingerprint, cached_run_name=None, verify_hash=False):
+    """Parse a single experiment without touching the database.
 
-    # Calculate current file hash
-    current_hash = calculate_file_hash(log_file)
+    Runs in a worker process, reading the hash cache installed by init_worker. cached_run_name is the run recorded for this log file, if any;
+    when its entry's config fingerprint still matches, the YAML configs are not parsed again.
+    Returns (run_name, cache_entry, series) where series is None if the log is unchanged and
+    else a list of (metric_type, metric, log_indices, timestamps, values) with only finite values.
+    """
+    log_file, hydra_yaml, config_yaml = experiment_files
 
-    with open(hydra_yaml, "r") as f:
-        hydra_config = yaml.safe_load(f)
+    config_fingerprint = configs_fingerprint(config_yaml, hydra_yaml)
+    cached_entry = _worker_hash_cache.get(cached_run_name) if cached_run_name is not None else None
+    if cached_entry is not None and cached_entry.get("config_fingerprint") == config_fingerprint:
+        run_name, num_train_iterations = cached_run_name, cached_entry["train_iterations"]
+    else:
+        with open(hydra_yaml, "r") as f:
+            hydra_config = yaml.load(f, Loader=YamlLoader)
 
-    with open(config_yaml, "r") as f:
-        config = yaml.safe_load(f)
-        num_train_iterations = config["agent"]["policy"]["train_iterations"]
-        run_name = config["job"]["name"]
-        if run_name == "default_run":
-            run_name = hydra_config["hydra"]["job"]["name"]
+        with open(config_yaml, "r") as f:
+            config = yaml.load(f, Loader=YamlLoader)
+            num_train_iterations = config["agent"]["policy"]["train_iterations"]
+            run_name = config["job"]["name"]
+            if run_name == "default_run":
+                run_name = hydra_config["hydra"]["job"]["name"]
 
-    # Check if hash has changed
-    if run_name in hash_cache and hash_cache[run_name] == current_hash:
+    # Check if the log file has changed
+    unchanged, cache_entry = log_file_unchanged(_worker_hash_cache.get(run_name), log_file, current_fingerprint, verify_hash)
+    cache_entry = {**cache_entry, "config_fingerprint": config_fingerprint, "train_iterations": num_train_iterations}
+    if unchanged:
         logging.info(f"No changes detected for {run_name}, skipping...")
-        return
+        return run_name, cache_entry, None
+
+    # The log is read in full below anyway; storing its hash lets a later --verify-hash run
+    # skip it if only its mtime changes
+    if "sha256" not in cache_entry:
+        cache_entry["sha256"] = calculate_file_hash(log_file)
+
+    with open_log_file(log_file) as f:
+        data = f["no_seed_provided"]
+
+        # Read every column in one full slice up front; all indexing below is on numpy arrays
+        column_data = {
+            metric_type: {metric: data[group][metric][:] for group, metric in layout}
+            for metric_type, layout in COLUMNS.items()
+        }
+        timestamps = parse_timestamps(data["time"]["time"][:])
+
+    # Every num_train_iterations-th row, starting at row num_train_iterations-1, closes an
+    # iteration; the other rows are steps
+    iteration_rows = np.arange(num_train_iterations - 1, len(timestamps), num_train_iterations)
+    row_indices = {
+        'iteration': iteration_rows,
+        'step': np.delete(np.arange(len(timestamps)), iteration_rows),
+    }
+
+    series = []
+    for metric_type, rows in row_indices.items():
+        for metric, column in column_data[metric_type].items():
+            # The k-th row of this type holds the k-th value of each of its columns
+            column = column[:len(rows)]
+            if len(column) < len(rows):
+                raise ValueError(f"{metric} has {len(column)} values for {len(rows)} {metric_type} rows")
 
+            try:
+                values = np.asarray(column, dtype=float)
+            except (ValueError, TypeError):
+                logging.warning(f"Error processing metric {metric}")
+                continue
+
+            finite = np.isfinite(values)
+            series.append((metric_type, metric, rows[finite], timestamps[rows[finite]], values[finite]))
+
+    return run_name, cache_entry, series
+
+def write_experiment(conn, run_name, series):
+    """Insert the series parsed for one experiment into the caller's open transaction."""
     cursor = conn.cursor()
-    
+    # Lets this experiment's inserts be undone without losing the rest of the transaction
+    cursor.execute("SAVEPOINT experiment")
     try:
-        with h5py.File(log_file, "r") as f:
-            data = f["no_seed_provided"]
-            stats = data["stats"]
-            time = data["time"]
-            
-            timestamps = time["time"][:]
-            timestamps = [timestamp.decode("utf-8") for timestamp in timestamps]
-            timestamp_indices = np.arange(len(timestamps))
-            
-            iteration_mask = ((timestamp_indices-(num_train_iterations-1)) % num_train_iterations == 0)
-            
-            iteration_counter = 0
-            step_counter = 0
-            
-            # Prepare batch inserts
-            records = []
-            
-            for idx, timestamp in enumerate(timestamps):
-                timestamp = datetime.strptime(timestamp, "%y-%m-%d/%H:%M")
-
-                if iteration_mask[idx]:
-                    fields = {
-                        "num_iterations": time["num_iterations"][iteration_counter],
-                        "val_loss": stats["val_loss"][iteration_counter],
-                        "final_goals_proven": stats["final_goals_proven"][iteration_counter],
-                        "ratio_proven": stats["ratio_proven"][iteration_counter],
-                        "mean_hard_sol_log_probs": stats["mean_hard_sol_log_probs"][iteration_counter]
-                    }
-                    metric_type = 'iteration'
-                    iteration_counter += 1
-                else:
-                    fields = {
-                        "num_steps": time["num_steps"][step_counter],
-                        "loss": stats["loss"][step_counter],
-                        "train_loss": stats["train_loss"][step_counter],
-                        "progress_loss": stats["progress_loss"][step_counter],
-                        "mu": stats["mu"][step_counter],
-                        "ratio_diff_problem_pairs": stats["ratio_diff_problem_pairs"][step_counter]
-                    }
-                    metric_type = 'step'
-                    step_counter += 1
-
-                for metric, value in fields.items():
-                    try:
-                        value = float(value)
-                        if not (np.isnan(value) or np.isinf(value)):
-                            records.append((
-                                run_name,
-                                timestamp,
-                                metric,
-                                value,
-                                metric_type
-                            ))
-                    except (ValueError, TypeError):
-                        logging.warning(f"Error processing metric {metric} with value {value}")
-                        continue
-
-            # Batch insert records
-            if records:
-                cursor.executemany(
-                    """
-                    INSERT INTO metrics (run_name, timestamp, metric_name, value, metric_type)
-                    VALUES (?, ?, ?, ?, ?)
-                    """,
-                    records
-                )
-                conn.commit()
-                logging.info(f"Inserted {len(records)} records for {run_name}")
-
-        # Update hash cache after successful processing
-        hash_cache[run_name] = current_hash
-        save_hash_cache(cache_file, hash_cache)
-        logging.info(f"Updated hash cache for {run_name}")
-
-    except Exception as e:
-        conn.rollback()
-        logging.error(f"Error processing experiment {run_name}: {str(e)}")
+        run_id = get_run_id(cursor, run_name)
+        # A changed log replaces everything ingested for the run before, including rows it no
+        # longer has (it got shorter, or values became non-finite)
+        cursor.execute("DELETE FROM metrics WHERE run_id = ?", (run_id,))
+        num_records = 0
+        for metric_type, metric, log_indices, timestamps, values in series:
+            metric_id = get_metric_id(cursor, metric, metric_type)
+            # One executemany per column; the constant ids are repeated rather than stored per row
+            cursor.executemany(INSERT_SQL, zip(
+                itertools.repeat(run_id),
+                itertools.repeat(metric_id),
+                log_indices.tolist(),
+                timestamps.tolist(),
+                values.tolist(),
+            ))
+            num_records += cursor.rowcount
+        if num_records > 0:
+            logging.info(f"Inserted {num_records} records for {run_name}")
+        cursor.execute("RELEASE experiment")
+    except Exception:
+        cursor.execute("ROLLBACK TO experiment")
+        cursor.execute("RELEASE experiment")
         raise
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--verify-hash", action="store_true",
+                        help="Hash log files whose size or mtime changed, and skip them if their content did not")
+    parser.add_argument("--fast", action="store_true",
+                        help="Disable fsync (PRAGMA synchronous=OFF); a crash or power loss may corrupt the database")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes parsing experiments in parallel")
+    args = parser.parse_args()
+
     # Create database directory if it doesn't exist
     db_dir = Path(os.path.dirname(__file__)) / "db"
     db_dir.mkdir(exist_ok=True)
     
     # Configure SQLite connection
     db_path = db_dir / "experiments.db"
-    conn = sqlite3.connect(str(db_path))
+    # Transactions are managed explicitly: experiments are batched into a few large commits
+    conn = sqlite3.connect(str(db_path), isolation_level=None)
+    configure_connection(conn, args.fast)
     
     # Create tables if they don't exist
     create_tables(conn)
 
-    # Initialize hash cache
-    cache_file = os.path.join(os.path.dirname(__file__), 'hdf5_hashes.json')
+    # Initialize hash cache; hd5f_to_influxdb.py keeps its own in hdf5_hashes.json
+    cache_file = os.path.join(os.path.dirname(__file__), 'hdf5_sqlite_cache.json')
     hash_cache = load_hash_cache(cache_file)
 
+    # Run names are only known after parsing the configs; this maps log files back to them
+    run_names_by_log = {entry["log_file"]: run_name for run_name, entry in hash_cache.items()}
+
     base_dir = os.getenv("EXPERIMENTS_DIR")
     
+    # For a new or small database, inserts are appended without index maintenance and the
+    # indexes are built in one sorted pass at the end. If ingest fails, create_tables restores
+    # them on the next run.
+    (num_rows,) = conn.execute("SELECT count(*) FROM metrics").fetchone()
+    rebuild_indexes = num_rows < REBUILD_INDEXES_MAX_ROWS
+    if rebuild_indexes:
+        drop_indexes(conn)
+
     try:
-        for experiment_name in os.listdir(base_dir):
-            experiment_path = os.path.join(base_dir, experiment_name)
-            if os.path.isdir(experiment_path):
+        # Experiments are parsed in worker processes; only this process writes to the DB and the cache
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                 initargs=(hash_cache,)) as executor:
+            futures = {}
+            experiments = [entry for entry in os.scandir(base_dir) if entry.is_dir()]
+            for experiment in experiments:
+                experiment_name = experiment.name
                 logging.info(f"Processing experiment: {experiment_name}")
+                experiment_files = locate_experiment_files(experiment.path)
+                if experiment_files is None:
+                    continue
+
+                # Cheap fingerprint of the log file; if it matches the entry recorded for this
+                # log file, skip the experiment without reading its configs or hashing the log
+                current_fingerprint = file_fingerprint(experiment_files[0])
+                run_name = run_names_by_log.get(experiment_files[0])
+                if run_name is not None and hash_cache[run_name].get("fingerprint") == current_fingerprint:
+                    logging.info(f"No changes detected for {run_name}, skipping...")
+                    continue
+
+                future = executor.submit(process_experiment, experiment_files, current_fingerprint,
+                                         run_name, args.verify_hash)
+                futures[future] = experiment_name
+
+            conn.execute("BEGIN")
+            for i, future in enumerate(as_completed(futures)):
+                experiment_name = futures[future]
                 try:
-                    process_experiment(experiment_path, conn, hash_cache, cache_file)
+                    run_name, cache_entry, series = future.result()
+                    if series is not None:
+                        write_experiment(conn, run_name, series)
+                    hash_cache[run_name] = cache_entry
+                    logging.info(f"Updated hash cache for {run_name}")
                 except Exception as e:
                     logging.error(f"Error processing {experiment_name}: {str(e)}")
-                    continue
+
+                if (i + 1) % COMMIT_EVERY == 0:
+                    conn.execute("COMMIT")
+                    save_hash_cache(cache_file, hash_cache)
+                    conn.execute("BEGIN")
+
+            conn.execute("COMMIT")
+        if rebuild_indexes:
+            create_indexes(conn)
+        # Saved only after a commit: on error, entries for rolled-back experiments must not be kept
+        save_hash_cache(cache_file, hash_cache)
     except Exception as e:
         logging.error(f"Error processing experiments: {str(e)}")
     finally:
         conn.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()